@@ -16,8 +16,11 @@ import warnings
 import numpy as np
 from numpy import linalg as LA
 import random
+import heapq
+import multiprocessing
 import ot
 from ot.lp import emd2
+from scipy.sparse import csr_matrix
 
 #########################################                                                                                                                                            
 # PROCESSING FUNCTIONS
@@ -226,6 +229,306 @@ def emd_Calc_Flow(ev0,ev1,M,maxIter=1000000):
     # returns the EMD between normalized events (e.g. multiply by event pT, eng, etc. to get dimensional value)                                                                                                                              
     return cost, log
     
+######################################
+# EMD BOUNDS AND THRESHOLD SELECTION
+
+## Cheap bounds on emd_Calc(ev0,ev1,M) that only use the distance MATRIX M, so they hold for the
+## distance measures above as well as for user defined matrices.
+## Lower bounds come from feasible dual potentials (u_i + v_j <= M_ij), upper bounds from feasible
+## transport plans. Both are exact inequalities, not approximations.
+
+# Dual potentials made feasible by alternating c-transforms, starting from the row potential u
+def _dual_Bound(ev0norm,ev1norm,M,u):
+    v = (M - u[:,np.newaxis]).min(axis=0)
+    u = (M - v[np.newaxis,:]).min(axis=1)
+    return ev0norm.dot(u) + ev1norm.dot(v)
+
+# Rounds an approximate plan P onto one with exactly the marginals a, b (Altschuler et al. 2017)
+def _round_Plan(P,a,b):
+    rowSum = P.sum(axis=1)
+    P = P*np.minimum(1., np.divide(a, rowSum, out=np.ones_like(a), where=rowSum>0))[:,np.newaxis]
+    colSum = P.sum(axis=0)
+    P = P*np.minimum(1., np.divide(b, colSum, out=np.ones_like(b), where=colSum>0))[np.newaxis,:]
+    errA = a - P.sum(axis=1)
+    errB = b - P.sum(axis=0)
+    if errA.sum()>0:
+        P = P + np.outer(errA, errB)/errA.sum()
+    return P
+
+# Plan sending all of the mass of each row to its nearest column, rounded to be feasible
+def _nearest_Plan(a,b,M):
+    P = np.zeros_like(M)
+    P[np.arange(len(a)), M.argmin(axis=1)] = a
+    return _round_Plan(P, a, b)
+
+# Tier 1 bounds, O(nm) and fully vectorized
+# Lower: nearest neighbour potentials, upper: nearest neighbour plans
+def emd_Bounds(ev0,ev1,M):
+    ev0norm = ev0[:]/ev0[:].sum()
+    ev1norm = ev1[:]/ev1[:].sum()
+    M = np.asarray(M, dtype=float)
+
+    lower = max(_dual_Bound(ev0norm, ev1norm, M, M.min(axis=1)), _dual_Bound(ev1norm, ev0norm, M.T, M.min(axis=0)))
+    upper = min((_nearest_Plan(ev0norm, ev1norm, M)*M).sum(), (_nearest_Plan(ev1norm, ev0norm, M.T)*M.T).sum())
+    return lower, upper
+
+# Tier 2 bounds from a few Sinkhorn iterations at regularization reg (in units of M.max())
+# Lower: c-transformed Sinkhorn potentials, upper: Sinkhorn plan rounded to be feasible
+def emd_Bounds_Entropic(ev0,ev1,M,reg=0.02,numIter=30):
+    ev0norm = ev0[:]/ev0[:].sum()
+    ev1norm = ev1[:]/ev1[:].sum()
+    M = np.asarray(M, dtype=float)
+
+    eps = reg*M.max()
+    if eps<=0:
+        return 0., 0.
+    K = np.exp(-M/eps)
+    u = np.ones(len(ev0norm))
+    v = np.ones(len(ev1norm))
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        for it in range(numIter):
+            u = ev0norm/K.dot(v)
+            v = ev1norm/K.T.dot(u)
+        f = eps*np.log(u)
+    # reg too small for the kernel to be represented, no bound from this tier
+    if not (np.all(np.isfinite(u)) and np.all(np.isfinite(v)) and np.all(np.isfinite(f[ev0norm>0]))):
+        return 0., np.inf
+    f[ev0norm==0] = M[ev0norm==0].min(axis=1)
+
+    lower = _dual_Bound(ev0norm, ev1norm, M, f)
+    upper = (_round_Plan(u[:,np.newaxis]*K*v[np.newaxis,:], ev0norm, ev1norm)*M).sum()
+    return lower, upper
+
+## Decides emd_Calc(ev0,ev1,M) > cut for every event, using the bounds above and only solving the
+## full LP when they straddle the cut.
+## evList0, evList1 and MList are sequences of the arguments of emd_Calc, one entry per event.
+## Returns a boolean ARRAY (True when the EMD is above cut) and a dictionary with the number of
+## events resolved by each tier ('bounds', 'entropic', 'exact').
+def emd_Cut(evList0,evList1,MList,cut,reg=0.02,numIter=30):
+    above = []
+    tiers = {'bounds': 0, 'entropic': 0, 'exact': 0}
+    for ev0, ev1, M in zip(evList0, evList1, MList):
+        lower, upper = emd_Bounds(ev0, ev1, M)
+        if lower>cut or upper<=cut:
+            tiers['bounds'] += 1
+            above.append(lower>cut)
+            continue
+        lower, upper = emd_Bounds_Entropic(ev0, ev1, M, reg=reg, numIter=numIter)
+        if lower>cut or upper<=cut:
+            tiers['entropic'] += 1
+            above.append(lower>cut)
+            continue
+        tiers['exact'] += 1
+        above.append(emd_Calc(ev0, ev1, M)>cut)
+    return np.array(above, dtype=bool), tiers
+
+######################################
+# ONE DIMENSIONAL EMD
+
+## Exact EMD for non-periodic one dimensional positions, e.g. polar angle theta or rapidity y,
+## with distance |x - y|^beta (unnormalized). For beta >= 1 the optimal transport is monotone,
+## so the EMD follows from the quantile functions after a sort, O(n log n) per event.
+## X, ev are ARRAYS of shape (nEv, n) with the positions and eng. measure values of a batch of
+## events (a single event may be passed as 1D arrays). Events with fewer particles are padded with
+## zero weights; lists of ARRAYS of different length are padded automatically.
+
+# Stacks a list of events of different length into (nEv, n) arrays, padding with zero weight
+def _pad_Events(X,ev):
+    if isinstance(X, np.ndarray) and isinstance(ev, np.ndarray):
+        return X.astype(float), ev.astype(float)
+    nPart = max(len(x) for x in X)
+    Xpad = np.zeros((len(X), nPart))
+    evPad = np.zeros((len(X), nPart))
+    for i in range(len(X)):
+        Xpad[i,:len(X[i])] = X[i]
+        evPad[i,:len(ev[i])] = ev[i]
+    return Xpad, evPad
+
+# Sorts every event and returns the positions with the cumulative normalized weights
+def _cdf_1D(X,ev,beta):
+    if beta < 1:
+        raise Exception('emdVar Error: beta must be at least 1 for the 1D EMD')
+    X, ev = _pad_Events(X, ev)
+    if X.shape != ev.shape:
+        raise Exception('emdVar Error: positions and weights must have the same shape')
+    order = np.argsort(X, axis=-1, kind='stable')
+    X = np.take_along_axis(X, order, axis=-1)
+    ev = np.take_along_axis(ev, order, axis=-1)
+    cdf = np.cumsum(ev, axis=-1)/ev.sum(axis=-1, keepdims=True)
+    return X, cdf
+
+## EMD to a discrete reference with positions Y and eng. measure values refEng (uniform if None)
+## Returns an ARRAY of the EMD of every event (a float for a single event)
+def emd_1D(X,ev,Y,refEng=None,beta=1.):
+    X, cdf = _cdf_1D(X, ev, beta)
+    single = X.ndim==1
+    X, cdf = np.atleast_2d(X), np.atleast_2d(cdf)
+    if refEng is None:
+        refEng = np.ones(len(Y))
+    Y, refCdf = _cdf_1D(np.asarray(Y), np.asarray(refEng), beta)
+
+    # Breakpoints of both quantile functions, evaluated at the middle of every interval
+    nEv, nPart = X.shape
+    t = np.sort(np.concatenate([cdf, np.broadcast_to(refCdf, (nEv, len(refCdf)))], axis=1), axis=1)
+    t = np.concatenate([np.zeros((nEv, 1)), np.minimum(t, 1.)], axis=1)
+    dt = np.diff(t, axis=1)
+    tMid = 0.5*(t[:,1:] + t[:,:-1])
+
+    # Batched searchsorted: shift every event into its own unit interval
+    shift = 2.*np.arange(nEv)[:,np.newaxis]
+    ind = np.searchsorted((cdf + shift).ravel(), (tMid + shift).ravel(), side='right').reshape(tMid.shape)
+    ind = np.minimum(ind - nPart*np.arange(nEv)[:,np.newaxis], nPart-1)
+    refInd = np.minimum(np.searchsorted(refCdf, tMid, side='right'), len(Y)-1)
+
+    cost = (dt*np.abs(np.take_along_axis(X, ind, axis=1) - Y[refInd])**beta).sum(axis=1)
+    return cost[0] if single else cost
+
+# Antiderivative of |x - s|^beta in s
+def _prim_1D(X,s,beta):
+    return -np.sign(X-s)*np.abs(X-s)**(beta+1)/(beta+1)
+
+## EMD to the continuous uniform distribution on [lo, hi]
+## Returns an ARRAY of the EMD of every event (a float for a single event)
+def emd_1D_Uniform(X,ev,lo,hi,beta=1.):
+    if not hi > lo:
+        raise Exception('emdVar Error: hi must be larger than lo')
+    X, cdf = _cdf_1D(X, ev, beta)
+    single = X.ndim==1
+    X, cdf = np.atleast_2d(X), np.atleast_2d(cdf)
+
+    # Particle k is sent to the reference interval [s0, s1] matching its stretch of the CDF
+    s1 = lo + (hi-lo)*np.minimum(cdf, 1.)
+    s0 = np.concatenate([np.full((len(X), 1), float(lo)), s1[:,:-1]], axis=1)
+    cost = (_prim_1D(X, s1, beta) - _prim_1D(X, s0, beta)).sum(axis=1)/(hi-lo)
+    return cost[0] if single else cost
+
+######################################
+# EVENT TO EVENT EMD
+
+## evList is a list of the ARRAYS of eng. measure values of each event, pointList the list of the
+## matching particle positions, and distFunc(X,Y) returns the distance MATRIX between two such sets
+## of positions, e.g. _cdist_cos or functools.partial(_cdist_phi_y, ym=ymax).
+## With nJobs > 1 the rows are spread over a multiprocessing pool, so distFunc must be picklable
+## (a module level function or a functools.partial, not a lambda).
+
+# EMD between events i and j of the batch
+def _pair_Calc(evList,pointList,distFunc,i,j):
+    M = distFunc(pointList[i], pointList[j])
+    return emd_Calc(evList[i], evList[j], M)
+
+# Row i of the upper triangle, EMD to all events j > i
+def _pair_Row(evList,pointList,distFunc,i):
+    return np.array([_pair_Calc(evList, pointList, distFunc, i, j) for j in range(i+1, len(evList))])
+
+# Batch shared with the pool workers, set once per worker by the pool initializer
+_poolArgs = None
+
+def _pool_Init(*args):
+    global _poolArgs
+    _poolArgs = args
+
+def _pool_Row(i):
+    return _pair_Row(*(_poolArgs + (i,)))
+
+def _pool_Knn(rows):
+    return _knn_Rows(*(_poolArgs + (rows,)))
+
+# Runs func over the tasks, in a pool of nJobs workers if nJobs > 1
+def _pair_Map(func,tasks,args,nJobs):
+    if nJobs is None or nJobs>1:
+        pool = multiprocessing.Pool(nJobs, initializer=_pool_Init, initargs=args)
+        try:
+            return pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    _pool_Init(*args)
+    try:
+        return [func(task) for task in tasks]
+    finally:
+        _pool_Init()
+
+## All pairs EMD. Only the upper triangle is solved.
+## Returns the condensed distance ARRAY, ordered as in scipy.spatial.distance.squareform,
+## i.e. (0,1), (0,2), ..., (0,N-1), (1,2), ...
+def emd_Pairs(evList,pointList,distFunc,nJobs=1):
+    if len(evList) != len(pointList):
+        raise Exception('emdVar Error: evList and pointList must have the same length')
+    rows = _pair_Map(_pool_Row, range(len(evList)-1), (evList, pointList, distFunc), nJobs)
+    if len(rows)==0:
+        return np.zeros(0)
+    return np.concatenate(rows)
+
+# Nearest neighbours of the events in rows. Candidates are visited in order of their pivot lower
+# bound and dropped without a full solve once a lower bound reaches the current k-th distance.
+def _knn_Rows(evList,pointList,distFunc,k,pivots,beta,rows):
+    counts = {'pivots': 0, 'bounds': 0, 'exact': 0}
+    solved = {}
+    out = []
+    for i in rows:
+        # Triangle inequality on W = EMD^(1/beta) through every pivot
+        if pivots is None:
+            lbPiv = np.zeros(len(evList))
+        else:
+            lbPiv = (np.abs(pivots - pivots[i])**beta).max(axis=1)
+        order = [j for j in np.argsort(lbPiv, kind='stable') if j != i]
+        best = [] # max heap of (-emd, j)
+        for n, j in enumerate(order):
+            full = len(best)==k
+            if full and lbPiv[j] >= -best[0][0]:
+                counts['pivots'] += len(order) - n
+                break
+            key = (min(i,j), max(i,j))
+            if key not in solved:
+                M = distFunc(pointList[i], pointList[j])
+                if full and emd_Bounds(evList[i], evList[j], M)[0] >= -best[0][0]:
+                    counts['bounds'] += 1
+                    continue
+                solved[key] = emd_Calc(evList[i], evList[j], M)
+                counts['exact'] += 1
+            if not full:
+                heapq.heappush(best, (-solved[key], j))
+            elif solved[key] < -best[0][0]:
+                heapq.heapreplace(best, (-solved[key], j))
+        out.append(sorted((-d, j) for d, j in best))
+    return out, counts
+
+## k nearest neighbours of every event of the batch under the EMD.
+## pivots is an optional ARRAY of shape (N,) or (N,P) with the EMD of every event to P fixed reference
+## events, e.g. the event isotropies, used with the triangle inequality to skip pairs without solving them.
+## This requires distFunc to be a metric raised to the power beta (beta = 2 for _cdist_cos and _cdist_phi_y,
+## beta = 1 for _cdist_phi_y_sqrt and _cdist_phi), in which case EMD^(1/beta) is itself a metric.
+## Returns the kNN graph as a sparse (N,N) csr_matrix holding the EMD to the k neighbours of each row,
+## and a dictionary counting the pairs skipped by the pivots ('pivots'), skipped by emd_Bounds ('bounds')
+## and solved in full ('exact').
+def emd_Knn(evList,pointList,distFunc,k,pivots=None,beta=1.,nJobs=1):
+    nEv = len(evList)
+    if len(pointList) != nEv:
+        raise Exception('emdVar Error: evList and pointList must have the same length')
+    if not (float(k).is_integer()) or k < 1 or k >= nEv:
+        raise Exception('emdVar Error: k must be a positive integer smaller than the number of events')
+    if beta < 1:
+        raise Exception('emdVar Error: beta must be at least 1')
+    k = int(k)
+    if pivots is not None:
+        pivots = np.asarray(pivots, dtype=float).reshape(nEv, -1)**(1./beta)
+
+    nBlocks = 1 if nJobs==1 else (nJobs or multiprocessing.cpu_count())
+    blocks = [rows for rows in np.array_split(np.arange(nEv), nBlocks) if len(rows)>0]
+    results = _pair_Map(_pool_Knn, blocks, (evList, pointList, distFunc, k, pivots, beta), nJobs)
+
+    rowInd, colInd, dist = [], [], []
+    counts = {'pivots': 0, 'bounds': 0, 'exact': 0}
+    for rows, (out, blockCounts) in zip(blocks, results):
+        for i, neighbours in zip(rows, out):
+            for d, j in neighbours:
+                rowInd.append(i)
+                colInd.append(j)
+                dist.append(d)
+        for key in counts:
+            counts[key] += blockCounts[key]
+    return csr_matrix((dist, (rowInd, colInd)), shape=(nEv, nEv)), counts
+
 ########################################
 # EMD Visualization
 #######################################
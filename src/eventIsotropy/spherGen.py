@@ -29,6 +29,9 @@ def eta(px, py, pz):
 def pT(px, py): 
     return np.sqrt(px**2+py**2)
 
+def theta(px, py, pz):
+    return np.arccos(pz/np.sqrt(px**2+py**2+pz**2))
+
 ##################
 
 ## Function generates the point on a evenly tiled sphere using HEALPIX from Astropy_HEALPIX
@@ -93,6 +96,13 @@ def etaFromVec(vecArray):
     etaVals = [eta(vec[0], vec[1], vec[2]) for vec in vecArray]
     return np.array(etaVals)
 
+## Returns an array of the polar angle theta for all the particles in the passed array
+def thetaFromVec(vecArray):
+    if len(vecArray.shape) != 2 or vecArray.shape[1] != 3:
+        raise Exception('spherGen Error: invalid format. Enter array of 3 vectors')
+    thetaVals = [theta(vec[0], vec[1], vec[2]) for vec in vecArray]
+    return np.array(thetaVals)
+
 ## Returns a sphere + dijet event                                                                                                                                                                        
 def sphereAndDijet(nVal, djFrac):
     # Only allowed values of number of points is 12*(2**2i) for i an integer.                                                                                                                            